@@ -1,79 +1,73 @@
 import os
 import math
-import random
 import tempfile
 from collections import Counter
 
+import numpy as np
 import bpy
 import utils
 
 
-def add_random_objects(scene_struct, num_objects, args, camera, color_name_to_rgba, material_mapping, object_mapping, size_mapping):
-    positions = []
+def add_random_objects(scene_struct, num_objects, args, camera, color_names, color_rgba, material_mapping, object_mapping, size_names, size_radii, rng):
+    # Placement only happens on the ground plane, so we only need the x and y
+    # components of the cardinal directions
+    directions = np.array([scene_struct['directions'][name] for name in ['left', 'right', 'front', 'behind']])
+    assert np.all(directions[:, 2] == 0)
+    directions = directions[:, :2]
+
+    positions = np.zeros((num_objects, 2))
+    radii = np.zeros(num_objects)
     objects = []
     blender_objects = []
-    for _ in range(num_objects):
+    for i in range(num_objects):
         # Choose a random size
-        size_name, r = random.choice(size_mapping)
+        size_idx = rng.integers(len(size_names))
+        size_name, r = size_names[size_idx], float(size_radii[size_idx])
 
         # Try to place the object, ensuring that we don't intersect any existing
         # objects and that we are more than the desired margin away from all existing
-        # objects along all cardinal directions.
-        num_tries = 0
-        while True:
-            # If we try and fail to place an object too many times, then delete all
-            # the objects in the scene and start over.
-            num_tries += 1
-            if num_tries > args.max_retries:
-                for obj in blender_objects:
-                    utils.delete_object(obj)
-                return add_random_objects(scene_struct, num_objects, args, camera, color_name_to_rgba, material_mapping, object_mapping, size_mapping)
-            x = random.uniform(-3, 3)
-            y = random.uniform(-3, 3)
-            # Check to make sure the new object is further than min_dist from all
-            # other objects, and further than margin along the four cardinal directions
-            dists_good = True
-            margins_good = True
-            for (xx, yy, rr) in positions:
-                dx, dy = x - xx, y - yy
-                dist = math.sqrt(dx * dx + dy * dy)
-                if dist - r - rr < args.min_dist:
-                    dists_good = False
-                    break
-                for direction_name in ['left', 'right', 'front', 'behind']:
-                    direction_vec = scene_struct['directions'][direction_name]
-                    assert direction_vec[2] == 0
-                    margin = dx * direction_vec[0] + dy * direction_vec[1]
-                    if 0 < margin < args.margin:
-                        print(margin, args.margin, direction_name)
-                        print('BROKEN MARGIN!')
-                        margins_good = False
-                        break
-                if not margins_good:
-                    break
-
-            if dists_good and margins_good:
-                break
+        # objects along all cardinal directions. All max_retries candidate positions
+        # are drawn and checked at once, and the first one that passes is used.
+        candidates = rng.uniform(-3, 3, size=(args.max_retries, 2))
+        deltas = candidates[:, None, :] - positions[None, :i, :]
+
+        # Check to make sure the new object is further than min_dist from all
+        # other objects, and further than margin along the four cardinal directions
+        dists = np.linalg.norm(deltas, axis=2)
+        dists_good = np.all(dists - r - radii[None, :i] >= args.min_dist, axis=1)
+        margins = np.einsum('kjc,dc->kjd', deltas, directions)
+        margins_good = ~np.any((margins > 0) & (margins < args.margin), axis=(1, 2))
+        good = np.flatnonzero(dists_good & margins_good)
+
+        # If we fail to place an object too many times, then delete all the
+        # objects in the scene and start over.
+        if len(good) == 0:
+            for obj in blender_objects:
+                utils.delete_object(obj)
+            return add_random_objects(scene_struct, num_objects, args, camera, color_names, color_rgba, material_mapping, object_mapping, size_names, size_radii, rng)
+        x, y = [float(c) for c in candidates[good[0]]]
 
         # Choose random color and shape
-        obj_name, obj_name_out = random.choice(object_mapping)
-        color_name, rgba = random.choice(list(color_name_to_rgba.items()))
+        obj_name, obj_name_out = object_mapping[rng.integers(len(object_mapping))]
+        color_idx = rng.integers(len(color_names))
+        color_name, rgba = color_names[color_idx], color_rgba[color_idx]
         
         # For cube, adjust the size a bit
         if obj_name == 'Cube':
             r /= math.sqrt(2)
 
         # Choose random orientation for the object.
-        theta = 360.0 * random.random()
+        theta = 360.0 * rng.random()
 
         # Actually add the object to the scene
         utils.add_object(args.shape_dir, obj_name, r, (x, y), theta=theta)
         obj = bpy.context.object
         blender_objects.append(obj)
-        positions.append((x, y, r))
+        positions[i] = (x, y)
+        radii[i] = r
 
         # Attach a random material
-        mat_name, mat_name_out = random.choice(material_mapping)
+        mat_name, mat_name_out = material_mapping[rng.integers(len(material_mapping))]
         utils.add_material(mat_name, Color=rgba)
 
         # Record data about the object in the scene data structure
@@ -89,21 +83,21 @@ def add_random_objects(scene_struct, num_objects, args, camera, color_name_to_rg
         })
 
     # Check that all objects are at least partially visible in the rendered image
-    all_visible = check_visibility(blender_objects, args.min_pixels_per_object)
+    all_visible = check_visibility(blender_objects, args.min_pixels_per_object, rng)
     if not all_visible:
         # If any of the objects are fully occluded then start over; delete all
         # objects from the scene and place them all again.
         print('Some objects are occluded; replacing objects')
         for obj in blender_objects:
             utils.delete_object(obj)
-        return add_random_objects(scene_struct, num_objects, args, camera, color_name_to_rgba, material_mapping, object_mapping, size_mapping)
+        return add_random_objects(scene_struct, num_objects, args, camera, color_names, color_rgba, material_mapping, object_mapping, size_names, size_radii, rng)
 
     return objects, blender_objects
 
 
-def check_visibility(blender_objects, min_pixels_per_object):
+def check_visibility(blender_objects, min_pixels_per_object, rng):
     f, path = tempfile.mkstemp(suffix='.png')
-    object_colors = render_shadeless(blender_objects, path=path)
+    object_colors = render_shadeless(blender_objects, rng, path=path)
     img = bpy.data.images.load(path)
     p = list(img.pixels)
     color_count = Counter((p[i], p[i+1], p[i+2], p[i+3]) for i in range(0, len(p), 4))
@@ -116,18 +110,21 @@ def check_visibility(blender_objects, min_pixels_per_object):
     return True
 
 
-def render_shadeless(blender_objects, path='flat.png'):
+def render_shadeless(blender_objects, rng, path='flat.png'):
     render_args = bpy.context.scene.render
 
     # Cache the render args we are about to clobber
     old_filepath = render_args.filepath
     old_engine = render_args.engine
     old_use_antialiasing = render_args.use_antialiasing
+    old_file_format = render_args.image_settings.file_format
 
-    # Override some render settings to have flat shading
+    # Override some render settings to have flat shading. The colors are read back
+    # exactly, so the image has to be written losslessly.
     render_args.filepath = path
     render_args.engine = 'BLENDER_RENDER'
     render_args.use_antialiasing = False
+    render_args.image_settings.file_format = 'PNG'
 
     # Move the lights and ground to layer 2 so they don't render
     utils.set_layer(bpy.data.objects['Lamp_Key'], 2)
@@ -144,7 +141,7 @@ def render_shadeless(blender_objects, path='flat.png'):
         mat = bpy.data.materials['Material']
         mat.name = 'Material_%d' % i
         while True:
-            r, g, b = [random.random() for _ in range(3)]
+            r, g, b = rng.random(3).tolist()
             if (r, g, b) not in object_colors: break
         object_colors.add((r, g, b))
         mat.diffuse_color = [r, g, b]
@@ -168,5 +165,6 @@ def render_shadeless(blender_objects, path='flat.png'):
     render_args.filepath = old_filepath
     render_args.engine = old_engine
     render_args.use_antialiasing = old_use_antialiasing
+    render_args.image_settings.file_format = old_file_format
 
     return object_colors
@@ -1,8 +1,14 @@
 import os
+import sys
 import json
-import random
+import time
 import argparse
 
+import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import bpy
 from mathutils import Vector
 import utils
@@ -16,140 +22,264 @@ def main(args):
     # Load the property file
     with open(args.properties_json, 'r') as f:
         properties = json.load(f)
-        color_name_to_rgba = {}
-        for name, rgb in properties['colors'].items():
-            rgba = [float(c) / 255.0 for c in rgb] + [1.0]
-            color_name_to_rgba[name] = rgba
+        # Colors and sizes are stored as parallel name lists and float32 arrays so
+        # that every scene can share them without rebuilding anything
+        color_names = list(properties['colors'].keys())
+        color_rgba = np.array([[float(c) / 255.0 for c in rgb] + [1.0] for rgb in properties['colors'].values()], dtype=np.float32)
         material_mapping = [(v, k) for k, v in properties['materials'].items()]
         object_mapping = [(v, k) for k, v in properties['shapes'].items()]
-        size_mapping = list(properties['sizes'].items())
-
-    for output_index in range(args.start_index, args.num_images):
-        image_path = os.path.join(args.output_image_dir, f"{output_index}.png")
-        scene_path = os.path.join(args.output_scene_dir, f"{output_index}.json")
-
-        num_objects = random.randint(args.min_objects, args.max_objects)
-        render_scene(
-            args,
-            num_objects=num_objects,
-            output_index=output_index,
-            image_path=image_path,
-            scene_path=scene_path,
-            color_name_to_rgba=color_name_to_rgba,
-            material_mapping=material_mapping,
-            object_mapping=object_mapping,
-            size_mapping=size_mapping,
-        )
+        size_names = list(properties['sizes'].keys())
+        size_radii = np.array(list(properties['sizes'].values()), dtype=np.float32)
 
+    if not bpy.app.background:
+        print('Warning: not running in background mode; run blender with --background for faster rendering')
 
-def render_scene(args, num_objects, output_index, image_path, scene_path, color_name_to_rgba, material_mapping, object_mapping, size_mapping):
-    # Load the main blendfile
+    # Load the main blendfile and materials once; every scene is built on top of
+    # this state and torn down again after it is rendered.
     bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
-
-    # Load materials
     utils.load_materials(args.material_dir)
 
     # Set render arguments so we can get pixel coordinates later. We use functionality specific to the CYCLES renderer so BLENDER_RENDER cannot be used.
     render_args = bpy.context.scene.render
     render_args.engine = "CYCLES"
-    render_args.filepath = image_path
     render_args.resolution_x = args.width
     render_args.resolution_y = args.height
     render_args.resolution_percentage = 100
-    render_args.tile_x = args.render_tile_size
-    render_args.tile_y = args.render_tile_size
 
-    cycles_prefs = bpy.context.user_preferences.addons['cycles'].preferences
-    cycles_prefs.compute_device_type = 'CUDA'
+    # Write 8-bit RGB images. At this resolution compression saves little space and costs
+    # a noticeable fraction of the render time.
+    render_args.image_settings.file_format = args.image_format
+    render_args.image_settings.color_mode = 'RGB'
+    render_args.image_settings.color_depth = '8'
+    if args.image_format == 'PNG':
+        render_args.image_settings.compression = args.png_compression
+    else:
+        render_args.image_settings.quality = args.jpeg_quality
+
+    # Nothing needs to react to our renders, and the scene graph, shaders and BVH can
+    # be kept between renders instead of being rebuilt for each image
+    for handlers in [bpy.app.handlers.render_pre, bpy.app.handlers.render_post, bpy.app.handlers.render_complete]:
+        handlers.clear()
+    render_args.use_lock_interface = True
+    render_args.use_persistent_data = True
 
     bpy.data.worlds['World'].cycles.sample_as_light = True
     bpy.context.scene.cycles.blur_glossy = 2.0
     bpy.context.scene.cycles.samples = args.render_num_samples
     bpy.context.scene.cycles.transparent_min_bounces = args.render_min_bounces
     bpy.context.scene.cycles.transparent_max_bounces = args.render_max_bounces
-    bpy.context.scene.cycles.device = 'GPU'
+
+    # Denoising lets us get away with far fewer samples
+    if args.use_denoise:
+        for layer in bpy.context.scene.render.layers:
+            layer.cycles.use_denoising = True
+
+    # Render on every available GPU, falling back to the CPU if there are none. When
+    # sharding, each shard gets its own GPU.
+    gpus = utils.enable_gpus(gpu_index=args.shard_index if args.num_shards > 1 else None)
+    bpy.context.scene.cycles.device = 'GPU' if len(gpus) > 0 else 'CPU'
+
+    # GPUs render fastest with large tiles, CPUs with small ones
+    tile_size = args.render_tile_size if len(gpus) > 0 else args.render_tile_size_cpu
+    render_args.tile_x = tile_size
+    render_args.tile_y = tile_size
+
+    # Figure out the left, up, and behind directions along the ground plane. These only depend
+    # on the camera orientation, which never changes, so they are shared by every scene.
+    directions = compute_plane_directions(bpy.data.objects['Camera'])
+
+    # Remember where the camera and lamps start so the per-scene jitter can be undone
+    base_locations = {}
+    for name in ['Camera', 'Lamp_Key', 'Lamp_Back', 'Lamp_Fill']:
+        base_locations[name] = bpy.data.objects[name].location.copy()
+
+    # Without an explicit seed every run gets fresh randomness; print the seed so the run can be reproduced
+    seed = args.seed
+    if seed is None:
+        seed = int.from_bytes(os.urandom(8), 'little')
+    print(f"Using seed {seed}")
+
+    image_ext = 'png' if args.image_format == 'PNG' else 'jpg'
+
+    for output_index in iter_output_indices(args):
+        image_path = os.path.join(args.output_image_dir, f"{output_index}.{image_ext}")
+        scene_path = os.path.join(args.output_scene_dir, f"{output_index}.json")
+
+        # Every scene gets its own generator so that any index can be regenerated exactly.
+        # SeedSequence mixes the two values, so different seeds never produce overlapping scenes.
+        rng = np.random.default_rng([seed, output_index])
+        num_objects = int(rng.integers(args.min_objects, args.max_objects + 1))
+        render_scene(
+            args,
+            num_objects=num_objects,
+            output_index=output_index,
+            image_path=image_path,
+            scene_path=scene_path,
+            color_names=color_names,
+            color_rgba=color_rgba,
+            material_mapping=material_mapping,
+            object_mapping=object_mapping,
+            size_names=size_names,
+            size_radii=size_radii,
+            base_locations=base_locations,
+            directions=directions,
+            seed=seed,
+            rng=rng,
+        )
+
+
+def iter_output_indices(args):
+    if args.read_indices_from_stdin:
+        # Keep the process (and its loaded scene) alive and render whatever is asked for.
+        # Each line is either a single index or a half-open range "start end".
+        # Malformed lines are skipped so bad input doesn't kill the worker.
+        for line in sys.stdin:
+            fields = line.split()
+            if len(fields) == 0:
+                continue
+            try:
+                if len(fields) == 1:
+                    start = int(fields[0])
+                    end = start + 1
+                elif len(fields) == 2:
+                    start, end = int(fields[0]), int(fields[1])
+                else:
+                    raise ValueError
+                # Indices seed the scene generator, so they must be non-negative
+                if start < 0 or start > end:
+                    raise ValueError
+                indices = range(start, end)
+            except ValueError:
+                print(f"Ignoring malformed index line: {line.strip()}")
+                continue
+            yield from indices
+    else:
+        # Each shard renders every num_shards-th image, starting from its own offset
+        yield from range(args.start_index + args.shard_index, args.num_images, args.num_shards)
+
+
+def render_scene(args, num_objects, output_index, image_path, scene_path, color_names, color_rgba, material_mapping, object_mapping, size_names, size_radii, base_locations, directions, seed, rng):
+    bpy.context.scene.render.filepath = image_path
 
     scene_struct = {
         'image_index': output_index,
+        'seed': seed,
         'objects': [],
-        'directions': {},
+        'directions': dict(directions),
         'relationships': {},
     }
 
-    # Put a plane on the ground so we can compute cardinal directions
-    bpy.ops.mesh.primitive_plane_add(radius=5)
-    plane = bpy.context.object
-
-    # Add random jitter to camera position
-    if args.camera_jitter > 0:
-        for i in range(3):
-            bpy.data.objects['Camera'].location[i] += 2.0 * args.camera_jitter * (random.random() - 0.5)
-
-    # Figure out the left, up, and behind directions along the plane and record them in the scene structure
     camera = bpy.data.objects['Camera']
-    plane_normal = plane.data.vertices[0].normal
-    cam_behind = camera.matrix_world.to_quaternion() * Vector((0, 0, -1))
-    cam_left = camera.matrix_world.to_quaternion() * Vector((-1, 0, 0))
-    cam_up = camera.matrix_world.to_quaternion() * Vector((0, 1, 0))
-    plane_behind = (cam_behind - cam_behind.project(plane_normal)).normalized()
-    plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
-    plane_up = cam_up.project(plane_normal).normalized()
+    lamp_key = bpy.data.objects['Lamp_Key']
+    lamp_back = bpy.data.objects['Lamp_Back']
+    lamp_fill = bpy.data.objects['Lamp_Fill']
 
-    # Delete the plane; we only used it for normals anyway. The base scene file contains the actual ground plane.
-    utils.delete_object(plane)
-
-    # Save all six axis-aligned directions in the scene struct
-    scene_struct['directions']['behind'] = tuple(plane_behind)
-    scene_struct['directions']['front'] = tuple(-plane_behind)
-    scene_struct['directions']['left'] = tuple(plane_left)
-    scene_struct['directions']['right'] = tuple(-plane_left)
-    scene_struct['directions']['above'] = tuple(plane_up)
-    scene_struct['directions']['below'] = tuple(-plane_up)
+    # Add random jitter to camera position. This only translates the camera, so the
+    # precomputed directions are still exact.
+    if args.camera_jitter > 0:
+        camera.location += Vector(args.camera_jitter * rng.uniform(-1, 1, 3))
 
     # Add random jitter to lamp positions
     if args.key_light_jitter > 0:
-        for i in range(3):
-            bpy.data.objects['Lamp_Key'].location[i] += 2.0 * args.key_light_jitter * (random.random() - 0.5)
+        lamp_key.location += Vector(args.key_light_jitter * rng.uniform(-1, 1, 3))
     if args.back_light_jitter > 0:
-        for i in range(3):
-            bpy.data.objects['Lamp_Back'].location[i] += 2.0 * args.back_light_jitter * (random.random() - 0.5)
+        lamp_back.location += Vector(args.back_light_jitter * rng.uniform(-1, 1, 3))
     if args.fill_light_jitter > 0:
-        for i in range(3):
-            bpy.data.objects['Lamp_Fill'].location[i] += 2.0 * args.fill_light_jitter * (random.random() - 0.5)
+        lamp_fill.location += Vector(args.fill_light_jitter * rng.uniform(-1, 1, 3))
 
     # Now make some random objects
-    objects, blender_objects = add_random_objects(scene_struct, num_objects, args, camera, color_name_to_rgba, material_mapping, object_mapping, size_mapping)
+    objects, blender_objects = add_random_objects(scene_struct, num_objects, args, camera, color_names, color_rgba, material_mapping, object_mapping, size_names, size_radii, rng)
 
     # Render the scene and dump the scene data structure
     scene_struct['objects'] = objects
     scene_struct['relationships'] = compute_all_relationships(scene_struct)
-    while True:
+    rendered = False
+    for attempt in range(args.max_render_retries):
         try:
             bpy.ops.render.render(write_still=True)
+            rendered = True
             break
         except Exception as e:
-            print(e)
+            print(f"Failed to render image {output_index} (attempt {attempt + 1} of {args.max_render_retries}): {e}")
+            if attempt + 1 < args.max_render_retries:
+                # Free whatever the failed render left behind and retry with fewer samples after a
+                # backoff, capped so that a large retry count can't stall the run for hours
+                utils.remove_orphan_data()
+                bpy.context.scene.cycles.samples = max(1, bpy.context.scene.cycles.samples // 2)
+                time.sleep(min(2 ** attempt, 60))
+    bpy.context.scene.cycles.samples = args.render_num_samples
+
+    # If every attempt failed, skip this scene rather than writing a scene file without an image
+    if rendered:
+        # orjson is much faster than json but is not bundled with Blender's Python
+        if orjson is not None:
+            with open(scene_path, 'wb') as f:
+                f.write(orjson.dumps(scene_struct))
+        else:
+            with open(scene_path, 'w') as f:
+                json.dump(scene_struct, f)
+    else:
+        print(f"Giving up on image {output_index}")
+
+    # Reset the base scene for the next image: remove the objects we added, free
+    # their meshes and materials, and undo the camera and lamp jitter
+    for obj in blender_objects:
+        utils.delete_object(obj)
+    utils.remove_orphan_data()
+    for name, location in base_locations.items():
+        bpy.data.objects[name].location = location
+
 
-    with open(scene_path, 'w') as f:
-        json.dump(scene_struct, f)
+def compute_plane_directions(camera):
+    # Put a plane on the ground so we can compute cardinal directions
+    bpy.ops.mesh.primitive_plane_add(radius=5)
+    plane = bpy.context.object
+
+    plane_normal = plane.data.vertices[0].normal
+    cam_behind = camera.matrix_world.to_quaternion() * Vector((0, 0, -1))
+    cam_left = camera.matrix_world.to_quaternion() * Vector((-1, 0, 0))
+    cam_up = camera.matrix_world.to_quaternion() * Vector((0, 1, 0))
+    plane_behind = (cam_behind - cam_behind.project(plane_normal)).normalized()
+    plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
+    plane_up = cam_up.project(plane_normal).normalized()
+
+    # Delete the plane; we only used it for normals anyway. The base scene file contains the actual ground plane.
+    utils.delete_object(plane)
+    utils.remove_orphan_data()
+
+    # Return all six axis-aligned directions
+    return {
+        'behind': tuple(plane_behind),
+        'front': tuple(-plane_behind),
+        'left': tuple(plane_left),
+        'right': tuple(-plane_left),
+        'above': tuple(plane_up),
+        'below': tuple(-plane_up),
+    }
 
 
 def compute_all_relationships(scene_struct, eps=0.2):
+    # front is the negation of behind and right is the negation of left, so we
+    # only project onto one direction per axis and split the result by sign
+    opposite = {'behind': 'front', 'left': 'right'}
     all_relationships = {}
-    for name, direction_vec in scene_struct['directions'].items():
-        if name == 'above' or name == 'below': continue
-        all_relationships[name] = []
-        for i, obj1 in enumerate(scene_struct['objects']):
-            coords1 = obj1['3d_coords']
-            related = set()
-            for j, obj2 in enumerate(scene_struct['objects']):
-                if obj1 == obj2: continue
-                coords2 = obj2['3d_coords']
-                diff = [coords2[k] - coords1[k] for k in [0, 1, 2]]
-                dot = sum(diff[k] * direction_vec[k] for k in [0, 1, 2])
-                if dot > eps:
-                    related.add(j)
-            all_relationships[name].append(sorted(list(related)))
+    if len(scene_struct['objects']) == 0:
+        for name in opposite:
+            all_relationships[name] = []
+            all_relationships[opposite[name]] = []
+        return all_relationships
+
+    # dots[d, i, j] is the displacement from object i to object j projected onto direction d
+    coords = np.array([obj['3d_coords'] for obj in scene_struct['objects']], dtype=np.float64)
+    dirs = np.array([scene_struct['directions'][name] for name in opposite], dtype=np.float64)
+    diff = coords[None, :, :] - coords[:, None, :]
+    dots = np.einsum('dk,ijk->dij', dirs, diff)
+
+    # An object is never related to itself; skip pairs by index (i == j), not by comparing objects
+    not_self = ~np.eye(len(coords), dtype=bool)
+    for d, name in enumerate(opposite):
+        all_relationships[name] = [np.where(row)[0].tolist() for row in (dots[d] > eps) & not_self]
+        all_relationships[opposite[name]] = [np.where(row)[0].tolist() for row in (dots[d] < -eps) & not_self]
     return all_relationships
 
 
@@ -165,8 +295,15 @@ if __name__ == '__main__':
     parser.add_argument('--output_image_dir', default='../output/images/')
     parser.add_argument('--output_scene_dir', default='../output/scenes/')
 
+    parser.add_argument('--seed', default=None, type=int)
     parser.add_argument('--start_index', default=0, type=int)
     parser.add_argument('--num_images', default=5, type=int)
+    parser.add_argument('--num_shards', default=1, type=int)
+    parser.add_argument('--shard_index', default=0, type=int)
+    parser.add_argument('--read_indices_from_stdin', action='store_true')
+    parser.add_argument('--image_format', default='PNG', choices=['PNG', 'JPEG'])
+    parser.add_argument('--png_compression', default=0, type=int)
+    parser.add_argument('--jpeg_quality', default=90, type=int)
     parser.add_argument('--width', default=320, type=int)
     parser.add_argument('--height', default=240, type=int)
 
@@ -182,10 +319,25 @@ if __name__ == '__main__':
     parser.add_argument('--min_pixels_per_object', default=200, type=int)
     parser.add_argument('--max_retries', default=50, type=int)
 
-    parser.add_argument('--render_num_samples', default=512, type=int)
-    parser.add_argument('--render_min_bounces', default=8, type=int)
-    parser.add_argument('--render_max_bounces', default=8, type=int)
+    parser.add_argument('--render_num_samples', default=128, type=int)
+    parser.add_argument('--render_min_bounces', default=4, type=int)
+    parser.add_argument('--render_max_bounces', default=4, type=int)
+    parser.add_argument('--use_denoise', action='store_true')
     parser.add_argument('--render_tile_size', default=256, type=int)
+    parser.add_argument('--render_tile_size_cpu', default=32, type=int)
+    parser.add_argument('--max_render_retries', default=5, type=int)
     args = parser.parse_args(argv)
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error('--shard_index must be in [0, --num_shards)')
+    if args.max_render_retries < 1:
+        parser.error('--max_render_retries must be at least 1')
+    if args.seed is not None and args.seed < 0:
+        parser.error('--seed must be non-negative')
+
+    # Starting Blender and loading the base scene takes a few seconds, so each process
+    # should render enough images for that cost to disappear
+    images_per_shard = (args.num_images - args.start_index) // args.num_shards
+    if args.num_shards > 1 and not args.read_indices_from_stdin and images_per_shard < 50:
+        print(f"Warning: each shard only renders about {images_per_shard} images; use fewer shards so startup cost is amortized")
     
     main(args)
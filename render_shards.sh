@@ -0,0 +1,54 @@
+#!/bin/bash
+# Render images with several Blender processes in parallel. Each process renders
+# a disjoint subset of the image indices and binds to its own GPU.
+#
+# Usage: ./render_shards.sh NUM_SHARDS [render_images.py arguments]
+#   e.g. ./render_shards.sh 4 --num_images 10000
+#
+# Each shard pays Blender's startup and scene loading cost once, so give every
+# shard at least ~50 images.
+#
+# --read_indices_from_stdin is not supported here: the shards run in the
+# background with no standard input, so they would exit without rendering. To
+# feed a long-running worker "INDEX" or "START END" lines, start blender directly
+# with render_images.py and pipe the indices into it.
+#
+# If --seed is not given, one seed is drawn here and passed to every shard, so
+# that this single number (printed below) reproduces the whole run.
+#
+# Set BLENDER to the blender binary if it is not on the PATH.
+
+NUM_SHARDS=${1:?usage: $0 NUM_SHARDS [render_images.py arguments]}
+shift
+BLENDER=${BLENDER:-blender}
+
+for arg in "$@"; do
+  if [ "$arg" = "--read_indices_from_stdin" ]; then
+    echo "$0: --read_indices_from_stdin cannot be used with background shards" >&2
+    exit 1
+  fi
+done
+
+SEED_ARGS=()
+if [[ " $* " != *" --seed "* && " $* " != *" --seed="* ]]; then
+  SEED=$(od -An -N4 -tu4 /dev/urandom | tr -d ' ')
+  echo "Using seed $SEED"
+  SEED_ARGS=(--seed "$SEED")
+fi
+
+PIDS=()
+for ((i = 0; i < NUM_SHARDS; i++)); do
+  "$BLENDER" --background --python render_images.py -- \
+    --num_shards "$NUM_SHARDS" --shard_index "$i" "${SEED_ARGS[@]}" "$@" > "shard_$i.log" 2>&1 &
+  PIDS+=($!)
+done
+
+# Wait for every shard and report the ones that failed
+STATUS=0
+for ((i = 0; i < NUM_SHARDS; i++)); do
+  if ! wait "${PIDS[$i]}"; then
+    echo "$0: shard $i failed; see shard_$i.log" >&2
+    STATUS=1
+  fi
+done
+exit $STATUS
@@ -42,6 +42,49 @@ def delete_object(obj):
   bpy.ops.object.delete()
 
 
+def remove_orphan_data():
+  """
+  Remove meshes, materials and images that are no longer used by anything in
+  the scene, e.g. those left behind by delete_object. Blender only frees these
+  when the file is reloaded, so a long-running script has to do it by hand.
+  """
+  for collection in [bpy.data.meshes, bpy.data.materials, bpy.data.images]:
+    for datablock in list(collection):
+      if datablock.users == 0:
+        collection.remove(datablock)
+
+
+def enable_gpus(device_types=('OPTIX', 'CUDA'), gpu_index=None):
+  """
+  Turn on every GPU that Cycles can find, trying the compute backends in
+  device_types in order of preference. Setting compute_device_type alone is not
+  enough; each device also has to be enabled, or Cycles quietly renders on the
+  CPU.
+
+  If gpu_index is given, only GPU number gpu_index (modulo the number of GPUs)
+  is enabled; this lets several Blender processes share a machine.
+
+  Returns the list of enabled devices, which is empty if no GPU is available.
+  """
+  cycles_prefs = bpy.context.user_preferences.addons['cycles'].preferences
+  for device_type in device_types:
+    try:
+      cycles_prefs.compute_device_type = device_type
+    except TypeError:
+      # This build of Blender does not support this backend
+      continue
+    cycles_prefs.get_devices()
+    gpus = [d for d in cycles_prefs.devices if d.type == device_type]
+    if len(gpus) > 0:
+      if gpu_index is not None:
+        gpus = [gpus[gpu_index % len(gpus)]]
+      for d in cycles_prefs.devices:
+        d.use = any(d == gpu for gpu in gpus)
+      return gpus
+  cycles_prefs.compute_device_type = 'NONE'
+  return []
+
+
 def get_camera_coords(cam, pos):
   """
   For a specified point, get both the 3D coordinates and 2D pixel-space